@@ -1,31 +1,57 @@
 # file: app/main.py
 from __future__ import annotations
 
+import asyncio
+import ipaddress
+import logging
 import os
 import re
+from contextlib import asynccontextmanager
 from typing import Any, Dict, Optional, List, Tuple, Union
 
 import httpx
+import orjson
+from cachetools import TTLCache
 from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
 
 # -----------------------------
 # Config (env)
 # -----------------------------
 API_KEY = os.getenv("API_KEY", "change-me")
 
-ORDER_ID_REGEX = os.getenv("ORDER_ID_REGEX", r"^#?[A-Za-z0-9_-]{3,20}$")
+_DEFAULT_ORDER_ID_REGEX = r"^#?[A-Za-z0-9_-]{3,20}$"
+ORDER_ID_REGEX = os.getenv("ORDER_ID_REGEX", _DEFAULT_ORDER_ID_REGEX)
 ORDER_ID_PATTERN = re.compile(ORDER_ID_REGEX)
+# Plain ASCII-digit ids always satisfy the default pattern, so they can skip the regex
+_ORDER_ID_DIGIT_FAST_PATH = ORDER_ID_REGEX == _DEFAULT_ORDER_ID_REGEX
+
+# Cheap syntactic email check; the address is only accepted for compatibility
+EMAIL_REGEX = r"^[^@\s]+@[^@\s]+\.[^@\s]+$"
 
 # Toggleable IP allowlist (set ENFORCE_IP_ALLOWLIST=false to disable)
 ENFORCE_IP_ALLOWLIST = os.getenv("ENFORCE_IP_ALLOWLIST", "true").lower() == "true"
-ALLOWED_PROXY_IPS = set(
+ALLOWED_PROXY_IPS = frozenset(
     (os.getenv("ALLOWED_PROXY_IPS") or "34.228.46.223,34.230.166.144")
     .replace(" ", "")
     .split(",")
 )
 
+def _canonical_ip(ip: str) -> str:
+    # Normalize spellings (e.g. expanded IPv6); leave non-IP strings untouched
+    try:
+        return str(ipaddress.ip_address(ip))
+    except ValueError:
+        return ip
+
+_ALLOWED_PROXY_IPS_BYTES = frozenset(_canonical_ip(ip).encode() for ip in ALLOWED_PROXY_IPS)
+
+# App log level; DEBUG enables the per-request diagnostics
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+
 # Support contact to show customers
 SUPPORT_CONTACT = os.getenv("SUPPORT_CONTACT", "daniel@moduswines.com")
 
@@ -34,11 +60,40 @@ WS_ENABLE = os.getenv("WS_ENABLE", "true").lower() == "true"
 WS_BASE_URL = os.getenv("WS_BASE_URL", "https://api.wineshipping.com/v3")
 WS_TIMEOUT_S = float(os.getenv("WS_TIMEOUT_S", "4.0"))
 
+# Connection pool sizing for the shared WS client
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", "100"))
+WS_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("WS_MAX_KEEPALIVE_CONNECTIONS", "20"))
+WS_KEEPALIVE_EXPIRY_S = float(os.getenv("WS_KEEPALIVE_EXPIRY_S", "60.0"))
+
+# HTTP/2 lets concurrent lookups multiplex on one connection (falls back to 1.1 via ALPN)
+WS_HTTP2 = os.getenv("WS_HTTP2", "true").lower() == "true"
+
+# In-process GetDetails cache (hits and 404s are kept for separate TTLs)
+WS_CACHE_MAXSIZE = int(os.getenv("WS_CACHE_MAXSIZE", "4096"))  # 0 or less disables the cache
+WS_CACHE_TTL_S = float(os.getenv("WS_CACHE_TTL_S", "60"))
+WS_CACHE_MISS_TTL_S = float(os.getenv("WS_CACHE_MISS_TTL_S", "10"))
+
 # Body-based auth fields (kept)
 WS_USER_KEY = os.getenv("WS_USER_KEY", "")
 WS_PASSWORD = os.getenv("WS_PASSWORD", "")
 WS_CUSTOMER_NO = os.getenv("WS_CUSTOMER_NO", "")
 
+# WS is usable only when enabled and fully credentialed
+_WS_READY = bool(WS_ENABLE and WS_USER_KEY and WS_PASSWORD and WS_CUSTOMER_NO)
+
+# AuthenticationDetails block sent in every GetDetails body (never mutated)
+_WS_AUTH = {
+    "UserKey": WS_USER_KEY,
+    "Password": WS_PASSWORD,
+    "CustomerNo": WS_CUSTOMER_NO,
+}
+
+# Static request headers, baked into the shared WS client
+_WS_HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+}
+
 # -----------------------------
 # Schemas
 # -----------------------------
@@ -49,33 +104,109 @@ class FoundResponse(BaseModel):
 class NotFoundResponse(BaseModel):
     context: str
 
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib encoder."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
 # -----------------------------
 # App
 # -----------------------------
-app = FastAPI(title="Order Tracking (Wineshipping only)", version="2.2.0")
+def _configure_logging() -> None:
+    # Single handler on the app logger; idempotent across reloads
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(LOG_LEVEL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _configure_logging()
+    # One pooled client for the app lifetime so WS lookups reuse kept-alive connections
+    app.state.ws_client = httpx.AsyncClient(
+        base_url=WS_BASE_URL.rstrip("/"),
+        headers=_WS_HEADERS,
+        http2=WS_HTTP2,
+        timeout=WS_TIMEOUT_S,
+        limits=httpx.Limits(
+            max_keepalive_connections=WS_MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=WS_MAX_CONNECTIONS,
+            keepalive_expiry=WS_KEEPALIVE_EXPIRY_S,
+        ),
+    )
+    try:
+        yield
+    finally:
+        await app.state.ws_client.aclose()
+
+app = FastAPI(
+    title="Order Tracking (Wineshipping only)",
+    version="2.2.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # -----------------------------
 # Middleware: IP allowlist (optional)
 # -----------------------------
-if ENFORCE_IP_ALLOWLIST:
-    @app.middleware("http")
-    async def ip_allowlist_middleware(request: Request, call_next):
-        xff = request.headers.get("x-forwarded-for", "")
-        chain = [ip.strip() for ip in xff.split(",") if ip.strip()]
-        candidate_ip = chain[0] if chain else (request.client.host if request.client else "")
-        if candidate_ip not in ALLOWED_PROXY_IPS:
+# Pre-encoded 403 response, sent as-is on every rejection
+_FORBIDDEN_BODY = orjson.dumps({"detail": "Forbidden"})
+_FORBIDDEN_HEADERS = [
+    (b"content-type", b"application/json"),
+    (b"content-length", str(len(_FORBIDDEN_BODY)).encode()),
+]
+
+class IPAllowlistMiddleware:
+    """
+    Pure ASGI middleware: reads the client IP straight from the scope so
+    rejected requests never build a Request or go through BaseHTTPMiddleware.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # Only the leftmost non-empty X-Forwarded-For entry matters; compare raw bytes
+        candidate_ip = b""
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                head, _, rest = value.partition(b",")
+                candidate_ip = head.strip()
+                while not candidate_ip and rest:
+                    head, _, rest = rest.partition(b",")
+                    candidate_ip = head.strip()
+                break
+        if not candidate_ip:
+            client = scope.get("client")
+            candidate_ip = client[0].encode() if client else b""
+        if (
+            candidate_ip not in _ALLOWED_PROXY_IPS_BYTES
+            # Slow path: retry with the canonical form before rejecting
+            and _canonical_ip(candidate_ip.decode("latin-1")).encode() not in _ALLOWED_PROXY_IPS_BYTES
+        ):
             # Minimal logging — no sensitive data
-            print(f"DEBUG: Rejected IP {candidate_ip}")
-            return JSONResponse(status_code=403, content={"detail": "Forbidden"})
-        return await call_next(request)
+            logger.debug("Rejected IP %s", candidate_ip.decode("latin-1"))
+            await send({"type": "http.response.start", "status": 403, "headers": _FORBIDDEN_HEADERS})
+            await send({"type": "http.response.body", "body": _FORBIDDEN_BODY})
+            return
+        return await self.app(scope, receive, send)
+
+if ENFORCE_IP_ALLOWLIST:
+    app.add_middleware(IPAllowlistMiddleware)
 
 # -----------------------------
 # Auth dependency
 # -----------------------------
-def require_api_key(x_api_key: Optional[str] = Header(default=None)):
+async def require_api_key(x_api_key: Optional[str] = Header(default=None)):
     # Do not log secrets
     if not x_api_key or x_api_key != API_KEY:
-        print("DEBUG: API key invalid or missing")  # safe message
+        logger.debug("API key invalid or missing")  # safe message
         raise HTTPException(status_code=401, detail=None)
 
 # -----------------------------
@@ -100,28 +231,32 @@ FULFILLMENT_STATUS_MESSAGES: Dict[str, str] = {
     "DAMAGED": "Carrier reported damage; shipment is still in transit.",
 }
 
+# Fields that may carry a status code, in priority order
+_STATUS_CODE_FIELDS = ("FulfillmentStatus", "StatusCode", "Status", "CarrierStatus")
+
 def _friendly_from_status_fields(d: Dict[str, Any]) -> str:
     """
     Try to derive a customer-friendly line from Wineshipping status fields.
     We look for a code-like field first, then fall back to text descriptions.
     """
-    # Try typical fields that may contain a code
-    code_candidates = [
-        d.get("FulfillmentStatus"),
-        d.get("StatusCode"),
-        d.get("Status"),
-        d.get("CarrierStatus"),
-    ]
-    code = next((c for c in code_candidates if isinstance(c, str)), None)
+    # Try typical fields that may contain a code (JSON strings are never str subclasses)
+    code = None
+    for field in _STATUS_CODE_FIELDS:
+        value = d.get(field)
+        if type(value) is str:
+            code = value
+            break
     friendly = None
     if code:
-        key = code.strip().upper()
-        friendly = FULFILLMENT_STATUS_MESSAGES.get(key)
+        # WS sends upper-case codes, so try the exact key before upper-casing
+        key = code.strip()
+        friendly = FULFILLMENT_STATUS_MESSAGES.get(key) or FULFILLMENT_STATUS_MESSAGES.get(key.upper())
 
     # Fallback to descriptions if mapping not found
-    desc = d.get("StatusDescription") or d.get("Status") or d.get("CarrierStatus")
-    if not friendly and isinstance(desc, str) and desc.strip():
-        friendly = desc.strip()
+    if not friendly:
+        desc = d.get("StatusDescription") or d.get("Status") or d.get("CarrierStatus")
+        if type(desc) is str:
+            friendly = desc.strip() or None
 
     # Final fallback
     return friendly or "Order is on its way."
@@ -129,16 +264,15 @@ def _friendly_from_status_fields(d: Dict[str, Any]) -> str:
 # -----------------------------
 # WS helpers
 # -----------------------------
-def _ws_build_getdetails_body(order_no: str) -> Dict[str, Any]:
-    # AuthenticationDetails in BODY should remain
-    return {
-        "AuthenticationDetails": {
-            "UserKey": WS_USER_KEY,
-            "Password": WS_PASSWORD,
-            "CustomerNo": WS_CUSTOMER_NO,
-        },
-        "OrderNo": order_no
-    }
+# Short-lived caches of GetDetails results keyed by order number. Misses get
+# a shorter TTL so bursts for unknown orders are absorbed without hiding
+# newly created orders for long.
+_WS_CACHE_ENABLED = WS_CACHE_MAXSIZE > 0
+_WS_CACHE: TTLCache = TTLCache(maxsize=max(WS_CACHE_MAXSIZE, 1), ttl=WS_CACHE_TTL_S)
+_WS_MISS_CACHE: TTLCache = TTLCache(maxsize=max(WS_CACHE_MAXSIZE, 1), ttl=WS_CACHE_MISS_TTL_S)
+
+# In-flight GetDetails calls keyed by order number (single-flight)
+_WS_INFLIGHT: Dict[str, asyncio.Future] = {}
 
 def _status_line_and_url_from_ws_payload(payload: Union[List[Dict[str, Any]], Dict[str, Any]]) -> Tuple[str, Optional[str]]:
     def pick(d: Dict[str, Any]) -> Tuple[str, Optional[str]]:
@@ -158,49 +292,113 @@ def _status_line_and_url_from_ws_payload(payload: Union[List[Dict[str, Any]], Di
         return pick(payload)
     return "Order is on its way; follow via the provided tracking link.", None
 
-async def fetch_ws_getdetails(order_no: str) -> Optional[Union[List[Dict[str, Any]], Dict[str, Any]]]:
-    if not (WS_ENABLE and order_no and WS_USER_KEY and WS_PASSWORD and WS_CUSTOMER_NO):
-        print("DEBUG: WS disabled or missing credentials")
-        return None
-
-    url = WS_BASE_URL.rstrip("/") + "/api/Tracking/GetDetails"
-    body = _ws_build_getdetails_body(order_no)
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
+async def _ws_getdetails_request(client: httpx.AsyncClient, order_no: str) -> Optional[Union[List[Dict[str, Any]], Dict[str, Any]]]:
+    # AuthenticationDetails in BODY should remain
+    body = {"AuthenticationDetails": _WS_AUTH, "OrderNo": order_no}
 
-    async with httpx.AsyncClient() as client:
-        # Avoid logging credentials or full payloads
-        print(f"DEBUG: Calling WS GetDetails for order {order_no}")
-        try:
-            r = await client.post(url, headers=headers, json=body, timeout=WS_TIMEOUT_S)
-        except Exception as e:
-            print("DEBUG: WS request error:", e)
-            raise
-        print("DEBUG: WS response status:", r.status_code)
-        if r.status_code == 404:
-            return None
-        r.raise_for_status()
+    # Avoid logging credentials or full payloads
+    logger.debug("Calling WS GetDetails for order %s", order_no)
+    try:
+        r = await client.post("/api/Tracking/GetDetails", json=body)
+    except Exception as e:
+        logger.debug("WS request error: %s", e)
+        raise
+    logger.debug("WS response status: %s", r.status_code)
+    if r.status_code == 404:
+        if _WS_CACHE_ENABLED:
+            _WS_MISS_CACHE[order_no] = True
+        return None
+    r.raise_for_status()
+    try:
+        payload = orjson.loads(r.content)
+    except orjson.JSONDecodeError:
+        # orjson only takes BOM-less UTF-8; let httpx handle BOMs and other charsets
         try:
-            return r.json()
+            payload = r.json()
         except Exception:
-            print("DEBUG: WS response not JSON-decoded")
+            logger.debug("WS response not JSON-decoded")
             return {"StatusDescription": "Received non-JSON response"}
+    if _WS_CACHE_ENABLED:
+        # Empty payloads ([], {}, null) are misses to the caller; keep them on the short TTL
+        if payload:
+            _WS_CACHE[order_no] = payload
+        else:
+            _WS_MISS_CACHE[order_no] = True
+    return payload
+
+async def fetch_ws_getdetails(client: httpx.AsyncClient, order_no: str) -> Optional[Union[List[Dict[str, Any]], Dict[str, Any]]]:
+    if not (_WS_READY and order_no):
+        logger.debug("WS disabled or missing credentials")
+        return None
+
+    # Serve repeat lookups (refreshes, retries) without another round-trip
+    if _WS_CACHE_ENABLED:
+        if order_no in _WS_MISS_CACHE:
+            logger.debug("WS cache hit (not found) for order %s", order_no)
+            return None
+        cached = _WS_CACHE.get(order_no)
+        if cached is not None:
+            logger.debug("WS cache hit for order %s", order_no)
+            return cached
+
+    # Coalesce concurrent lookups for the same order onto one upstream call;
+    # shield it so one cancelled caller doesn't cancel it for the others.
+    task = _WS_INFLIGHT.get(order_no)
+    if task is None:
+        task = asyncio.ensure_future(_ws_getdetails_request(client, order_no))
+        _WS_INFLIGHT[order_no] = task
+
+        def _done(t: asyncio.Future) -> None:
+            _WS_INFLIGHT.pop(order_no, None)
+            # Mark the exception as retrieved in case every waiter was cancelled
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(_done)
+    else:
+        logger.debug("Joining in-flight WS GetDetails for order %s", order_no)
+    return await asyncio.shield(task)
 
 # -----------------------------
 # Health
 # -----------------------------
 @app.get("/health", tags=["meta"])
-def health():
+async def health():
     return {"status": "ok"}
 
+# -----------------------------
+# Response text
+# -----------------------------
+# Constant closing sentence shared by found and not-found messages
+_CONTACT_SUFFIX = f"For more information, contact {SUPPORT_CONTACT}."
+
+# Pre-rendered NotFoundResponse body; only the order id is spliced in per request
+_NOT_FOUND_TEMPLATE = orjson.dumps(
+    NotFoundResponse(
+        context=(
+            "Order __ORDER__ not found with the provided details. "
+            "Please double-check the order number or contact support for assistance. "
+            + _CONTACT_SUFFIX
+        )
+    ).model_dump()
+)
+
+def _not_found_response(order_id: str) -> Response:
+    # orjson.dumps(...)[1:-1] JSON-escapes the raw id without its surrounding quotes
+    body = _NOT_FOUND_TEMPLATE.replace(b"__ORDER__", orjson.dumps(order_id)[1:-1], 1)
+    return Response(content=body, status_code=404, media_type="application/json")
+
 # -----------------------------
 # Main Endpoint (WS only)
 # -----------------------------
+def _is_valid_order_id(order_id: str) -> bool:
+    if _ORDER_ID_DIGIT_FAST_PATH and 3 <= len(order_id) <= 20 and order_id.isascii() and order_id.isdigit():
+        return True
+    return ORDER_ID_PATTERN.fullmatch(order_id) is not None
+
 @app.get(
     "/order-lookup",
-    response_model=FoundResponse | NotFoundResponse,
+    response_model=None,
     responses={
         200: {"model": FoundResponse, "description": "Found Order"},
         401: {"description": "Unauthorized"},
@@ -209,54 +407,49 @@ def health():
     tags=["order"],
 )
 async def order_lookup(
+    request: Request,
     order_id: str = Query(..., description="Order number (exactly 5 digits, e.g., 40500)"),
-    customer_email: EmailStr = Query(..., description="Customer email (kept for compatibility; not used)"),
+    customer_email: str = Query(..., pattern=EMAIL_REGEX, max_length=254, description="Customer email (kept for compatibility; not used)"),
     _: Any = Depends(require_api_key),
 ):
     # Limit logging to non-PII
-    print("DEBUG: entering order_lookup with order_id:", order_id)
-
-    if not ORDER_ID_PATTERN.match(order_id.strip()):
-        print("DEBUG: order_id pattern mismatch", order_id)
-        return JSONResponse(
-            status_code=404,
-            content=NotFoundResponse(
-                context=(
-                    f"Order {order_id} not found with the provided details. "
-                    f"Please double-check the order number or contact support for assistance. "
-                    f"For more information, contact {SUPPORT_CONTACT}."
-                )
-            ).model_dump()
-        )
+    logger.debug("entering order_lookup with order_id: %s", order_id)
+
+    stripped = order_id.strip()
+    if not _is_valid_order_id(stripped):
+        logger.debug("order_id pattern mismatch %s", order_id)
+        return _not_found_response(order_id)
 
-    normalized = order_id.strip().lstrip("#")
+    normalized = stripped.lstrip("#")
     try:
-        ws_payload = await fetch_ws_getdetails(normalized)
+        ws_payload = await fetch_ws_getdetails(request.app.state.ws_client, normalized)
     except Exception as e:
-        print("DEBUG: exception in fetch_ws_getdetails:", e)
+        logger.debug("exception in fetch_ws_getdetails: %s", e)
         ws_payload = None
 
     if not ws_payload:
-        print("DEBUG: ws_payload is None; Not Found")
-        return JSONResponse(
-            status_code=404,
-            content=NotFoundResponse(
-                context=(
-                    f"Order {order_id} not found with the provided details. "
-                    f"Please double-check the order number or contact support for assistance. "
-                    f"For more information, contact {SUPPORT_CONTACT}."
-                )
-            ).model_dump()
-        )
+        logger.debug("ws_payload is None; Not Found")
+        return _not_found_response(order_id)
 
     status_line, tracking_url = _status_line_and_url_from_ws_payload(ws_payload)
     # Keep copy tight; itemization not available without Commerce7.
-    context = (
-        f"Order {order_id} found. {status_line} "
-        f"For more information, contact {SUPPORT_CONTACT}."
-    )
-    print("DEBUG: responding 200 for order_id:", order_id)
-    return JSONResponse(
-        status_code=200,
-        content=FoundResponse(context=context, tracking_url=tracking_url).model_dump()
+    context = f"Order {order_id} found. {status_line} {_CONTACT_SUFFIX}"
+    logger.debug("responding 200 for order_id: %s", order_id)
+    # Values are built locally; skip FoundResponse construction and validation
+    return ORJSONResponse(content={"context": context, "tracking_url": tracking_url})
+
+# -----------------------------
+# Entrypoint
+# -----------------------------
+if __name__ == "__main__":
+    # Equivalent CLI: uvicorn app.main:app --loop uvloop --http httptools
+    import uvicorn
+
+    uvicorn.run(
+        "app.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="uvloop",
+        http="httptools",
     )
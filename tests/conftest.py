@@ -0,0 +1,13 @@
+import os
+
+# app.main reads its config at import time, so pin it before any test imports it
+os.environ.update(
+    API_KEY="test-key",
+    ENFORCE_IP_ALLOWLIST="true",
+    ALLOWED_PROXY_IPS="34.228.46.223,2001:db8::1",
+    WS_ENABLE="true",
+    WS_USER_KEY="user",
+    WS_PASSWORD="secret",
+    WS_CUSTOMER_NO="cust",
+    WS_CACHE_MISS_TTL_S="10",
+)
@@ -0,0 +1,117 @@
+import asyncio
+import gc
+
+import httpx
+import pytest
+from cachetools import TTLCache
+
+import app.main as main
+
+API_HEADERS = {"x-api-key": "test-key", "x-forwarded-for": "34.228.46.223"}
+LOOKUP_PARAMS = {"order_id": "40500", "customer_email": "shopper@example.com"}
+
+
+@pytest.fixture(autouse=True)
+def _reset_ws_state():
+    main._WS_CACHE.clear()
+    main._WS_MISS_CACHE.clear()
+    main._WS_INFLIGHT.clear()
+    yield
+    main._WS_CACHE.clear()
+    main._WS_MISS_CACHE.clear()
+    main._WS_INFLIGHT.clear()
+
+
+def _upstream(handler) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://ws.test/v3")
+
+
+def _app_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://testserver")
+
+
+def test_concurrent_lookups_share_one_upstream_call():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"FulfillmentStatus": "SHIPPED"})
+
+    async def run():
+        main.app.state.ws_client = _upstream(handler)
+        async with _app_client() as client:
+            return await asyncio.gather(
+                *(client.get("/order-lookup", params=LOOKUP_PARAMS, headers=API_HEADERS) for _ in range(10))
+            )
+
+    responses = asyncio.run(run())
+
+    assert [r.status_code for r in responses] == [200] * 10
+    assert len(calls) == 1
+    assert main._WS_INFLIGHT == {}
+
+
+def test_cancelled_waiters_do_not_leak_unretrieved_exception():
+    async def handler(request):
+        await asyncio.sleep(0.05)
+        return httpx.Response(500)
+
+    async def run():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        upstream = _upstream(handler)
+        waiters = [asyncio.create_task(main.fetch_ws_getdetails(upstream, "40500")) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0.1)
+        del waiters
+        gc.collect()
+        await asyncio.sleep(0)
+        return errors
+
+    errors = asyncio.run(run())
+
+    assert errors == []
+    assert main._WS_INFLIGHT == {}
+
+
+def test_not_found_tombstone_expires_after_miss_ttl(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(
+        main, "_WS_MISS_CACHE", TTLCache(maxsize=16, ttl=main.WS_CACHE_MISS_TTL_S, timer=lambda: now[0])
+    )
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(404)
+
+    async def lookup():
+        return await main.fetch_ws_getdetails(_upstream(handler), "40500")
+
+    assert asyncio.run(lookup()) is None
+    assert asyncio.run(lookup()) is None
+    assert len(calls) == 1
+
+    now[0] += main.WS_CACHE_MISS_TTL_S
+    assert asyncio.run(lookup()) is None
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize(
+    "forwarded_for, expected",
+    [
+        ("2001:db8::1", 200),
+        ("2001:0db8:0000:0000:0000:0000:0000:0001", 200),
+        ("2001:db8::2", 403),
+    ],
+)
+def test_allowlist_matches_canonical_ipv6(forwarded_for, expected):
+    async def run():
+        async with _app_client() as client:
+            return await client.get("/health", headers={"x-forwarded-for": forwarded_for})
+
+    assert asyncio.run(run()).status_code == expected